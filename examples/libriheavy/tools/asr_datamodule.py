@@ -20,16 +20,18 @@
 
 import argparse
 import logging
-from typing import Dict, List, Union
+from typing import Dict, Iterator, List, Optional, Union
 
 import torch
 from lhotse import CutSet, Fbank, FbankConfig
 from lhotse.cut import Cut
 from lhotse.dataset import (
+    DynamicBucketingSampler,
     K2SpeechRecognitionDataset,
     SimpleCutSampler,
 )
 from lhotse.dataset.input_strategies import (
+    AudioSamples,
     BatchIO,
     OnTheFlyFeatures,
 )
@@ -77,11 +79,62 @@ class SpeechRecognitionDataset(K2SpeechRecognitionDataset):
 
         batch = {"inputs": inputs, "supervisions": supervision_intervals}
         if self.return_cuts:
-            batch["supervisions"]["cut"] = [cut for cut in cuts]
+            # `cuts` is an eager CutSet, so this does not re-read the manifest.
+            batch["supervisions"]["cut"] = list(cuts)
 
         return batch
 
 
+class CUDAPrefetcher:
+    """
+    Wrap a DataLoader so that the inputs of the next batch are copied
+    to GPU on a side stream while the current batch is being processed.
+    The inputs are expected to be in pinned memory.
+
+    It moves batch["inputs"] and, if present, batch["supervisions"]
+    ["num_frames"]. Other tensors, e.g., "num_samples" which is needed
+    on CPU with --gpu-fbank, are left untouched.
+    """
+
+    def __init__(self, dl: DataLoader, device: torch.device):
+        self.dl = dl
+        self.device = device
+        self.stream = torch.cuda.Stream(device=device)
+
+    def _preload(self, it: Iterator[Dict]) -> Optional[Dict]:
+        try:
+            batch = next(it)
+        except StopIteration:
+            return None
+        supervisions = batch["supervisions"]
+        with torch.cuda.stream(self.stream):
+            batch["inputs"] = batch["inputs"].to(
+                self.device, non_blocking=True
+            )
+            if "num_frames" in supervisions:
+                supervisions["num_frames"] = supervisions["num_frames"].to(
+                    self.device, non_blocking=True
+                )
+        return batch
+
+    def __iter__(self) -> Iterator[Dict]:
+        it = iter(self.dl)
+        batch = self._preload(it)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(self.stream)
+            # The tensors are used on the current stream, tell the caching
+            # allocator not to reuse their memory before it is done.
+            batch["inputs"].record_stream(current_stream)
+            if "num_frames" in batch["supervisions"]:
+                batch["supervisions"]["num_frames"].record_stream(
+                    current_stream
+                )
+            next_batch = self._preload(it)
+            yield batch
+            batch = next_batch
+
+
 class AsrDataModule:
     """
     DataModule for k2 ASR experiments.
@@ -106,6 +159,23 @@ class AsrDataModule:
             help="Maximum pooled recordings duration (seconds) in a "
             "single batch. You can reduce it if it causes CUDA OOM.",
         )
+        group.add_argument(
+            "--bucketing-sampler",
+            type=str2bool,
+            default=False,
+            help="When enabled, the batches will come from buckets of "
+            "similar duration, which reduces the padding. Note: the cuts "
+            "are not decoded in the order of the input manifest then, "
+            "while tools/merge_chunks.py expects the chunks of a recording "
+            "to be contiguous in the recognized manifest.",
+        )
+        group.add_argument(
+            "--num-buckets",
+            type=int,
+            default=30,
+            help="The number of buckets for the DynamicBucketingSampler "
+            "(you might want to increase it for larger datasets).",
+        )
         group.add_argument(
             "--return-cuts",
             type=str2bool,
@@ -120,6 +190,15 @@ class AsrDataModule:
             default=80,
             help="The number of melbank bins for fbank",
         )
+        group.add_argument(
+            "--gpu-fbank",
+            type=str2bool,
+            default=False,
+            help="When enabled, the dataloader returns raw audio samples "
+            "and the fbank features are computed on GPU with kaldifeat "
+            "in the main process, instead of on CPU in the dataloader "
+            "workers.",
+        )
         group.add_argument(
             "--num-workers",
             type=int,
@@ -127,29 +206,105 @@ class AsrDataModule:
             help="The number of training dataloader workers that "
             "collect the batches.",
         )
+        group.add_argument(
+            "--pin-memory",
+            type=str2bool,
+            default=torch.cuda.is_available(),
+            help="When enabled, the dataloader puts the batches into "
+            "page-locked memory, so that copying them to GPU can be "
+            "done asynchronously. Defaults to true if CUDA is available.",
+        )
+        group.add_argument(
+            "--persistent-workers",
+            type=str2bool,
+            default=True,
+            help="When enabled, the dataloader workers are kept alive "
+            "after the dataset has been consumed once. "
+            "It takes effect only when --num-workers > 0, and it makes "
+            "no difference for recognize.py, which iterates over the "
+            "dataloader only once.",
+        )
+        group.add_argument(
+            "--prefetch-factor",
+            type=int,
+            default=4,
+            help="The number of batches loaded in advance by each worker. "
+            "It takes effect only when --num-workers > 0.",
+        )
+        group.add_argument(
+            "--cuda-prefetch",
+            type=str2bool,
+            default=False,
+            help="When enabled and decoding on GPU, the inputs of the next "
+            "batch are copied to GPU on a separate CUDA stream while the "
+            "current batch is decoded. Use it with --pin-memory true.",
+        )
 
-    def dataloaders(self, cuts: CutSet) -> DataLoader:
+    def fbank_config(self) -> FbankConfig:
+        """Return the fbank config used by the dataloader. It is also used
+        to compute the features on GPU when --gpu-fbank is true.
+        """
+        return FbankConfig(num_mel_bins=self.args.num_mel_bins)
+
+    def dataloaders(
+        self, cuts: CutSet, device: Optional[torch.device] = None
+    ) -> Union[DataLoader, CUDAPrefetcher]:
+        """
+        Return the dataloader of the given cuts. If `device` is a CUDA
+        device and --cuda-prefetch is true, the dataloader is wrapped by
+        a `CUDAPrefetcher` which moves the inputs to `device`.
+        """
         logging.debug("About to create test dataset")
+        if self.args.gpu_fbank:
+            # Features are extracted by the caller, see
+            # recognize.py:compute_features()
+            input_strategy = AudioSamples()
+        else:
+            input_strategy = OnTheFlyFeatures(Fbank(self.fbank_config()))
         dataset = SpeechRecognitionDataset(
-            input_strategy=OnTheFlyFeatures(
-                Fbank(FbankConfig(num_mel_bins=self.args.num_mel_bins))
-            ),
+            input_strategy=input_strategy,
             return_cuts=self.args.return_cuts,
         )
 
-        sampler = SimpleCutSampler(
-            cuts,
-            max_duration=self.args.max_duration,
-            shuffle=False,
-            drop_last=False,
-        )
+        if self.args.bucketing_sampler:
+            logging.info("Using DynamicBucketingSampler.")
+            sampler = DynamicBucketingSampler(
+                cuts,
+                max_duration=self.args.max_duration,
+                num_buckets=self.args.num_buckets,
+                shuffle=False,
+                drop_last=False,
+            )
+        else:
+            logging.info("Using SimpleCutSampler.")
+            sampler = SimpleCutSampler(
+                cuts,
+                max_duration=self.args.max_duration,
+                shuffle=False,
+                drop_last=False,
+            )
 
         logging.debug("About to create test dataloader")
+        # prefetch_factor and persistent_workers are only allowed
+        # to be set when using multiprocessing loading.
+        worker_kwargs = {}
+        if self.args.num_workers > 0:
+            worker_kwargs = dict(
+                persistent_workers=self.args.persistent_workers,
+                prefetch_factor=self.args.prefetch_factor,
+            )
         dl = DataLoader(
             dataset,
             batch_size=None,
             sampler=sampler,
             num_workers=self.args.num_workers,
-            persistent_workers=False,
+            pin_memory=self.args.pin_memory,
+            **worker_kwargs,
         )
+        if (
+            device is not None
+            and device.type == "cuda"
+            and self.args.cuda_prefetch
+        ):
+            dl = CUDAPrefetcher(dl, device)
         return dl
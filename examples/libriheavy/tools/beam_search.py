@@ -15,12 +15,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import warnings
+import contextlib
+import heapq
+import math
 from dataclasses import dataclass, field
-from typing import Dict, List, Optional, Union
+from typing import Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
-from utils import row_splits_to_row_ids
 
 
 @dataclass
@@ -37,10 +39,72 @@ class DecodingResults:
     scores: Optional[List[List[float]]] = None
 
 
+def run_decoder(
+    model: torch.nn.Module,
+    decoder_input: torch.Tensor,
+) -> torch.Tensor:
+    """Run the decoder and the decoder projection of the joiner.
+
+    Hypotheses often share the same context, so the decoder is only run
+    on the unique rows of `decoder_input` and the results are scattered
+    back.
+
+    Args:
+      model:
+        The transducer model.
+      decoder_input:
+        A 2-D tensor of shape (num_hyps, context_size).
+    Returns:
+      Return a tensor of shape (num_hyps, joiner_dim).
+    """
+    unique_input, inverse = torch.unique(
+        decoder_input, dim=0, return_inverse=True
+    )
+    decoder_out = model.decoder(unique_input, need_pad=False).squeeze(1)
+    decoder_out = model.joiner.decoder_proj(decoder_out)
+    return decoder_out[inverse]
+
+
+def get_amp_context(use_amp: bool, encoder_out: torch.Tensor):
+    """Return the context manager to run the decoder and joiner in.
+
+    Autocast to bfloat16 is only used on CUDA; otherwise a no-op context
+    is returned.
+    """
+    if use_amp and encoder_out.is_cuda:
+        return torch.autocast("cuda", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def pack_encoder_out(
+    encoder_out: torch.Tensor,
+    encoder_out_lens: torch.Tensor,
+) -> Tuple[torch.nn.utils.rnn.PackedSequence, torch.Tensor]:
+    """Pack encoder_out for frame-synchronous decoding.
+
+    pack_padded_sequence() needs the lengths on CPU, so they are transferred
+    once here and returned, letting callers check them without another
+    synchronization.
+
+    Returns:
+      Return a tuple (packed_encoder_out, encoder_out_lens), where
+      encoder_out_lens is on CPU.
+    """
+    encoder_out_lens = encoder_out_lens.cpu()
+    packed_encoder_out = torch.nn.utils.rnn.pack_padded_sequence(
+        input=encoder_out,
+        lengths=encoder_out_lens,
+        batch_first=True,
+        enforce_sorted=False,
+    )
+    return packed_encoder_out, encoder_out_lens
+
+
 def greedy_search_batch(
     model: torch.nn.Module,
     encoder_out: torch.Tensor,
     encoder_out_lens: torch.Tensor,
+    use_amp: bool = False,
 ) -> DecodingResults:
     """Greedy search in batch mode. It hardcodes --max-sym-per-frame=1.
     Args:
@@ -51,6 +115,9 @@ def greedy_search_batch(
       encoder_out_lens:
         A 1-D tensor of shape (N,), containing number of valid frames in
         encoder_out before padding.
+      use_amp:
+        If True and encoder_out is on GPU, run the decoder and the joiner
+        in bfloat16 with torch.autocast.
     Returns:
       Return a DecodingResults object containing
       decoded result and corresponding timestamps.
@@ -58,11 +125,8 @@ def greedy_search_batch(
     assert encoder_out.ndim == 3
     assert encoder_out.size(0) >= 1, encoder_out.size(0)
 
-    packed_encoder_out = torch.nn.utils.rnn.pack_padded_sequence(
-        input=encoder_out,
-        lengths=encoder_out_lens.cpu(),
-        batch_first=True,
-        enforce_sorted=False,
+    packed_encoder_out, encoder_out_lens = pack_encoder_out(
+        encoder_out, encoder_out_lens
     )
 
     device = next(model.parameters()).device
@@ -90,59 +154,64 @@ def greedy_search_batch(
         dtype=torch.int64,
     )  # (N, context_size)
 
-    decoder_out = model.decoder(decoder_input, need_pad=False)
-    decoder_out = model.joiner.decoder_proj(decoder_out)
-    # decoder_out: (N, 1, decoder_out_dim)
+    amp = get_amp_context(use_amp, encoder_out)
 
-    encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
+    with amp:
+        decoder_out = run_decoder(model, decoder_input)
+        # decoder_out: (N, decoder_out_dim)
+
+        encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
 
     offset = 0
     for (t, batch_size) in enumerate(batch_size_list):
         start = offset
         end = offset + batch_size
-        current_encoder_out = encoder_out.data[start:end]
-        current_encoder_out = current_encoder_out.unsqueeze(1).unsqueeze(1)
-        # current_encoder_out's shape: (batch_size, 1, 1, encoder_out_dim)
+        current_encoder_out = encoder_out[start:end]
+        # current_encoder_out's shape: (batch_size, encoder_out_dim)
         offset = end
 
         decoder_out = decoder_out[:batch_size]
 
-        logits = model.joiner(
-            current_encoder_out, decoder_out.unsqueeze(1), project_input=False
-        )
-        # logits'shape (batch_size, 1, 1, vocab_size)
+        # The joiner works on inputs of any rank as long as they match,
+        # so we pass 2-D tensors and skip the reshapes to 4-D and back.
+        with amp:
+            logits = model.joiner(
+                current_encoder_out, decoder_out, project_input=False
+            )
+        # logits'shape (batch_size, vocab_size)
 
-        logits = logits.squeeze(1).squeeze(1)  # (batch_size, vocab_size)
-        log_probs = logits.log_softmax(dim=-1)
+        # Keep log_softmax in float32
+        log_probs = logits.float().log_softmax(dim=-1)
         assert log_probs.ndim == 2, log_probs.shape
-        y = log_probs.argmax(dim=1).tolist()
+        y = log_probs.argmax(dim=1)  # (batch_size,)
+        y_scores = log_probs.gather(1, y.unsqueeze(1)).squeeze(1)
+        # Transfer to CPU once per frame instead of once per token
+        y_list = y.tolist()
+        y_scores_list = y_scores.tolist()
         emitted = False
-        for i, v in enumerate(y):
+        for i, v in enumerate(y_list):
             if v not in (blank_id, unk_id):
                 hyps[i].append(v)
                 timestamps[i].append(t)
-                scores[i].append(log_probs[i, v].item())
+                scores[i].append(y_scores_list[i])
                 emitted = True
         if emitted:
-            # update decoder output
-            decoder_input = [h[-context_size:] for h in hyps[:batch_size]]
-            decoder_input = torch.tensor(
+            # update decoder output, the context of streams that have not
+            # emitted a token in this frame is left unchanged.
+            emitted_mask = (y != blank_id) & (y != unk_id)
+            decoder_input = decoder_input[:batch_size]
+            decoder_input = torch.where(
+                emitted_mask.unsqueeze(1),
+                torch.cat([decoder_input[:, 1:], y.unsqueeze(1)], dim=1),
                 decoder_input,
-                device=device,
-                dtype=torch.int64,
-            )
-            decoder_out = model.decoder(decoder_input, need_pad=False)
-            decoder_out = model.joiner.decoder_proj(decoder_out)
+            )  # (batch_size, context_size)
+            with amp:
+                decoder_out = run_decoder(model, decoder_input)
 
-    sorted_ans = [h[context_size:] for h in hyps]
-    ans = []
-    ans_timestamps = []
-    ans_scores = []
     unsorted_indices = packed_encoder_out.unsorted_indices.tolist()
-    for i in range(N):
-        ans.append(sorted_ans[unsorted_indices[i]])
-        ans_timestamps.append(timestamps[unsorted_indices[i]])
-        ans_scores.append(scores[unsorted_indices[i]])
+    ans = [hyps[j][context_size:] for j in unsorted_indices]
+    ans_timestamps = [timestamps[j] for j in unsorted_indices]
+    ans_scores = [scores[j] for j in unsorted_indices]
 
     return DecodingResults(
         hyps=ans,
@@ -154,7 +223,8 @@ def greedy_search_batch(
 @dataclass
 class Hypothesis:
     # The predicted tokens so far.
-    # Newly predicted tokens are appended to `ys`.
+    # Note: `ys`, `scores` and `timestamp` may be shared with other
+    # hypotheses, so they must not be modified in place.
     ys: List[int]
 
     # The log_prob of each token in ys[context_size:]
@@ -162,21 +232,27 @@ class Hypothesis:
     scores: List[float]
 
     # The log prob of ys.
-    # It contains only one entry.
-    log_prob: torch.Tensor
+    log_prob: float
 
     # timestamp[i] is the frame index after subsampling
     # on which ys[i] is decoded
     timestamp: List[int] = field(default_factory=list)
 
+    # It caches `key`, i.e., tuple(ys). Computed lazily if not given.
+    _key: Optional[Tuple[int, ...]] = field(default=None, repr=False)
+
     @property
-    def key(self) -> str:
-        """Return a string representation of self.ys"""
-        return "_".join(map(str, self.ys))
+    def key(self) -> Tuple[int, ...]:
+        """Return a hashable representation of self.ys"""
+        if self._key is None:
+            self._key = tuple(self.ys)
+        return self._key
 
 
 class HypothesisList(object):
-    def __init__(self, data: Optional[Dict[str, Hypothesis]] = None) -> None:
+    def __init__(
+        self, data: Optional[Dict[Tuple[int, ...], Hypothesis]] = None
+    ) -> None:
         """
         Args:
           data:
@@ -188,7 +264,7 @@ class HypothesisList(object):
             self._data = data
 
     @property
-    def data(self) -> Dict[str, Hypothesis]:
+    def data(self) -> Dict[Tuple[int, ...], Hypothesis]:
         return self._data
 
     def add(self, hyp: Hypothesis) -> None:
@@ -204,9 +280,9 @@ class HypothesisList(object):
         key = hyp.key
         if key in self:
             old_hyp = self._data[key]  # shallow copy
-            torch.logaddexp(
-                old_hyp.log_prob, hyp.log_prob, out=old_hyp.log_prob
-            )
+            # log-sum-exp of two scalars, plain Python is the fastest here
+            a, b = old_hyp.log_prob, hyp.log_prob
+            old_hyp.log_prob = max(a, b) + math.log1p(math.exp(-abs(a - b)))
         else:
             self._data[key] = hyp
 
@@ -244,7 +320,7 @@ class HypothesisList(object):
         assert key in self, f"{key} does not exist"
         del self._data[key]
 
-    def filter(self, threshold: torch.Tensor) -> "HypothesisList":
+    def filter(self, threshold: float) -> "HypothesisList":
         """Remove all Hypotheses whose log_prob is less than threshold.
 
         Caution:
@@ -262,14 +338,14 @@ class HypothesisList(object):
 
     def topk(self, k: int) -> "HypothesisList":
         """Return the top-k hypothesis."""
-        hyps = list(self._data.items())
-
-        hyps = sorted(hyps, key=lambda h: h[1].log_prob, reverse=True)[:k]
+        hyps = heapq.nlargest(
+            k, self._data.items(), key=lambda h: h[1].log_prob
+        )
 
         ans = HypothesisList(dict(hyps))
         return ans
 
-    def __contains__(self, key: str):
+    def __contains__(self, key: Tuple[int, ...]):
         return key in self._data
 
     def __iter__(self):
@@ -280,8 +356,8 @@ class HypothesisList(object):
 
     def __str__(self) -> str:
         s = []
-        for key in self:
-            s.append(key)
+        for key in self._data:
+            s.append("_".join(map(str, key)))
         return ", ".join(s)
 
 
@@ -301,15 +377,16 @@ def get_hyps_row_splits(hyps: List[HypothesisList]) -> torch.Tensor:
       Return the row_splits of given hyps. Note that
       the shape is on CPU.
     """
-    num_hyps = [len(h) for h in hyps]
-
-    # torch.cumsum() is inclusive sum, so we put a 0 at the beginning
-    # to get exclusive sum later.
-    num_hyps.insert(0, 0)
+    num_hyps = np.fromiter(
+        (len(h) for h in hyps), dtype=np.int32, count=len(hyps)
+    )
 
-    num_hyps = torch.tensor(num_hyps)
-    row_splits = torch.cumsum(num_hyps, dim=0, dtype=torch.int32)
-    return row_splits
+    # np.cumsum() is inclusive sum, so we put a 0 at the beginning
+    # to get exclusive sum.
+    row_splits = np.empty(len(hyps) + 1, dtype=np.int32)
+    row_splits[0] = 0
+    np.cumsum(num_hyps, out=row_splits[1:])
+    return torch.from_numpy(row_splits)
 
 
 def modified_beam_search(
@@ -318,6 +395,7 @@ def modified_beam_search(
     encoder_out_lens: torch.Tensor,
     beam: int = 4,
     temperature: float = 1.0,
+    use_amp: bool = False,
 ) -> Union[List[List[int]], DecodingResults]:
     """Beam search in batch mode with --max-sym-per-frame=1 being hardcoded.
 
@@ -333,6 +411,9 @@ def modified_beam_search(
         Number of active paths during the beam search.
       temperature:
         Softmax temperature.
+      use_amp:
+        If True and encoder_out is on GPU, run the decoder and the joiner
+        in bfloat16 with torch.autocast.
     Returns:
       Return a DecodingResults object containing
       decoded result and corresponding timestamps.
@@ -340,11 +421,8 @@ def modified_beam_search(
     assert encoder_out.ndim == 3, encoder_out.shape
     assert encoder_out.size(0) >= 1, encoder_out.size(0)
 
-    packed_encoder_out = torch.nn.utils.rnn.pack_padded_sequence(
-        input=encoder_out,
-        lengths=encoder_out_lens.cpu(),
-        batch_first=True,
-        enforce_sorted=False,
+    packed_encoder_out, encoder_out_lens = pack_encoder_out(
+        encoder_out, encoder_out_lens
     )
 
     blank_id = model.decoder.blank_id
@@ -362,23 +440,34 @@ def modified_beam_search(
         B[i].add(
             Hypothesis(
                 ys=[blank_id] * context_size,
-                log_prob=torch.zeros(1, dtype=torch.float32, device=device),
+                log_prob=0.0,
                 timestamp=[],
                 scores=[],
             )
         )
 
-    encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
+    amp = get_amp_context(use_amp, encoder_out)
+
+    with amp:
+        encoder_out = model.joiner.encoder_proj(packed_encoder_out.data)
+
+    # Each utterance has at most `beam` hypotheses, so the decoder inputs
+    # of all frames fit into these buffers. The CPU one is pinned so that
+    # it can be copied to the device asynchronously.
+    max_num_hyps = N * beam
+    decoder_input_cpu = torch.empty(
+        (max_num_hyps, context_size),
+        dtype=torch.int64,
+        pin_memory=device.type == "cuda",
+    )
+    decoder_input_np = decoder_input_cpu.numpy()
+    decoder_input_buf = torch.empty_like(decoder_input_cpu, device=device)
 
     offset = 0
     finalized_B = []
     for (t, batch_size) in enumerate(batch_size_list):
         start = offset
-        end = offset + batch_size
-        current_encoder_out = encoder_out.data[start:end]
-        current_encoder_out = current_encoder_out.unsqueeze(1).unsqueeze(1)
-        # current_encoder_out's shape is (batch_size, 1, 1, encoder_out_dim)
-        offset = end
+        offset += batch_size
 
         finalized_B = B[batch_size:] + finalized_B
         B = B[:batch_size]
@@ -389,101 +478,126 @@ def modified_beam_search(
         A = [list(b) for b in B]
         B = [HypothesisList() for _ in range(batch_size)]
 
-        ys_log_probs = torch.cat(
-            [hyp.log_prob.reshape(1, 1) for hyps in A for hyp in hyps]
-        )  # (num_hyps, 1)
+        num_hyps = int(hyps_row_splits[-1])
 
-        decoder_input = torch.tensor(
-            [hyp.ys[-context_size:] for hyps in A for hyp in hyps],
-            device=device,
-            dtype=torch.int64,
-        )  # (num_hyps, context_size)
+        # Copy the log_probs of all hypotheses to the device at once
+        ys_log_probs = torch.from_numpy(
+            np.fromiter(
+                (hyp.log_prob for hyps in A for hyp in hyps),
+                dtype=np.float32,
+                count=num_hyps,
+            )
+        )
+        ys_log_probs = ys_log_probs.to(device, non_blocking=True).unsqueeze(1)
+        # (num_hyps, 1)
+
+        # Note: the previous asynchronous copy from decoder_input_cpu has
+        # finished here, since each frame synchronizes when moving the
+        # top-k results to CPU below.
+        decoder_input_np[:num_hyps] = [
+            hyp.ys[-context_size:] for hyps in A for hyp in hyps
+        ]
+        decoder_input = decoder_input_buf[:num_hyps]
+        decoder_input.copy_(decoder_input_cpu[:num_hyps], non_blocking=True)
+        # (num_hyps, context_size)
+
+        with amp:
+            decoder_out = run_decoder(model, decoder_input)
+        # decoder_out is of shape (num_hyps, joiner_dim)
 
-        decoder_out = model.decoder(decoder_input, need_pad=False).unsqueeze(1)
-        decoder_out = model.joiner.decoder_proj(decoder_out)
-        # decoder_out is of shape (num_hyps, 1, 1, joiner_dim)
+        # on cpu
+        row_ids = torch.from_numpy(
+            np.repeat(
+                np.arange(batch_size, dtype=np.int64),
+                np.diff(hyps_row_splits.numpy()),
+            )
+        )
 
+        # Select the encoder frame of each hypothesis directly from the
+        # projected encoder output, which is of shape (sum_T, joiner_dim).
         # Note: For torch 1.7.1 and below, it requires a torch.int64 tensor
-        # as index, so we use `to(torch.int64)` below.
-        current_encoder_out = torch.index_select(
-            current_encoder_out,
-            dim=0,
-            index=row_splits_to_row_ids(hyps_row_splits).to(device),
-        )  # (num_hyps, 1, 1, encoder_out_dim)
-
-        logits = model.joiner(
-            current_encoder_out,
-            decoder_out,
-            project_input=False,
-        )  # (num_hyps, 1, 1, vocab_size)
-
-        logits = logits.squeeze(1).squeeze(1)  # (num_hyps, vocab_size)
-
-        log_probs = (logits / temperature).log_softmax(
+        # as index, row_ids is of dtype torch.int64.
+        current_encoder_out = encoder_out.index_select(
+            0, (start + row_ids).to(device)
+        )  # (num_hyps, encoder_out_dim)
+
+        with amp:
+            logits = model.joiner(
+                current_encoder_out,
+                decoder_out,
+                project_input=False,
+            )  # (num_hyps, vocab_size)
+
+        # Keep log_softmax in float32
+        log_probs = (logits.float() / temperature).log_softmax(
             dim=-1
         )  # (num_hyps, vocab_size)
 
-        log_probs_t = log_probs.reshape(-1)
-
         log_probs.add_(ys_log_probs)
 
         vocab_size = log_probs.size(-1)
 
-        log_probs = log_probs.reshape(-1)
+        # Pad the hypotheses of each utterance to the same number, so that
+        # the top-k of all utterances is computed by a single call.
+        max_hyps = int((hyps_row_splits[1:] - hyps_row_splits[:-1]).max())
+        padded_index = row_ids * max_hyps + (
+            torch.arange(num_hyps) - hyps_row_splits[row_ids]
+        )
+        padded_log_probs = log_probs.new_full(
+            (batch_size * max_hyps, vocab_size), float("-inf")
+        )
+        padded_log_probs.index_copy_(0, padded_index.to(device), log_probs)
 
-        row_splits = hyps_row_splits * vocab_size
+        topk_log_probs, topk_indexes = padded_log_probs.reshape(
+            batch_size, -1
+        ).topk(beam)
+        # (batch_size, beam)
 
-        for i in range(batch_size):
-            topk_log_probs, topk_indexes = log_probs[
-                row_splits[i] : row_splits[i + 1]
-            ].topk(beam)
-
-            current_log_probs = log_probs_t[
-                row_splits[i] : row_splits[i + 1]
-            ].cpu()
-
-            with warnings.catch_warnings():
-                warnings.simplefilter("ignore")
-                topk_hyp_indexes = (topk_indexes // vocab_size).tolist()
-                topk_token_indexes = (topk_indexes % vocab_size).tolist()
-            topk_indexes = topk_indexes.cpu()
-
-            for k in range(len(topk_hyp_indexes)):
-                hyp_idx = topk_hyp_indexes[k]
-                hyp = A[i][hyp_idx]
+        # Transfer the results of all utterances to CPU at once. float64
+        # represents both the float32 scores and the indexes exactly.
+        # Note: The score of a token is the log_prob of the new hypothesis,
+        # i.e., topk_log_probs.
+        topk_scores_list, topk_indexes_list = torch.stack(
+            [topk_log_probs.double(), topk_indexes.double()]
+        ).tolist()
 
-                new_ys = hyp.ys[:]
-                new_token = topk_token_indexes[k]
-                new_timestamp = hyp.timestamp[:]
-                new_scores = hyp.scores[:]
-                if new_token not in (blank_id, unk_id):
-                    new_ys.append(new_token)
-                    new_timestamp.append(t)
-                    new_scores.append(current_log_probs[topk_indexes[k]].item())
-
-                new_log_prob = topk_log_probs[k]
-                new_hyp = Hypothesis(
-                    ys=new_ys,
-                    scores=new_scores,
-                    log_prob=new_log_prob,
-                    timestamp=new_timestamp,
+        for i in range(batch_size):
+            for k in range(beam):
+                hyp_idx, new_token = divmod(
+                    int(topk_indexes_list[i][k]), vocab_size
                 )
+                hyp = A[i][hyp_idx]
+                new_log_prob = topk_scores_list[i][k]
+
+                if new_token in (blank_id, unk_id):
+                    # Most of the frames emit no token, in which case the
+                    # new hypothesis shares the history with its parent
+                    # instead of copying it.
+                    new_hyp = Hypothesis(
+                        ys=hyp.ys,
+                        scores=hyp.scores,
+                        log_prob=new_log_prob,
+                        timestamp=hyp.timestamp,
+                        _key=hyp.key,
+                    )
+                else:
+                    new_hyp = Hypothesis(
+                        ys=hyp.ys + [new_token],
+                        scores=hyp.scores + [new_log_prob],
+                        log_prob=new_log_prob,
+                        timestamp=hyp.timestamp + [t],
+                        _key=hyp.key + (new_token,),
+                    )
                 B[i].add(new_hyp)
 
     B = B + finalized_B
     best_hyps = [b.get_most_probable(length_norm=True) for b in B]
 
-    sorted_ans = [h.ys[context_size:] for h in best_hyps]
-    sorted_timestamps = [h.timestamp for h in best_hyps]
-    sorted_scores = [h.scores for h in best_hyps]
-    ans = []
-    ans_timestamps = []
-    ans_scores = []
     unsorted_indices = packed_encoder_out.unsorted_indices.tolist()
-    for i in range(N):
-        ans.append(sorted_ans[unsorted_indices[i]])
-        ans_timestamps.append(sorted_timestamps[unsorted_indices[i]])
-        ans_scores.append(sorted_scores[unsorted_indices[i]])
+    best_hyps = [best_hyps[j] for j in unsorted_indices]
+    ans = [h.ys[context_size:] for h in best_hyps]
+    ans_timestamps = [h.timestamp for h in best_hyps]
+    ans_scores = [h.scores for h in best_hyps]
 
     return DecodingResults(
         hyps=ans,
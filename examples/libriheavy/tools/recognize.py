@@ -33,13 +33,14 @@ https://huggingface.co/Zengwei/icefall-asr-librispeech-zipformer-2023-05-15
 """
 
 import argparse
+import math
 import torch.multiprocessing as mp
 import torch
 import torch.nn as nn
 import logging
 import re
 from concurrent.futures import ThreadPoolExecutor
-from typing import List, Optional, Tuple
+from typing import Iterable, List, Optional, Tuple
 
 from pathlib import Path
 
@@ -47,11 +48,11 @@ from asr_datamodule import AsrDataModule
 from beam_search import greedy_search_batch, modified_beam_search
 from utils import SymbolTable, convert_timestamp
 
-from lhotse import CutSet, combine, load_manifest_lazy
+from lhotse import CutSet, FbankConfig, combine, load_manifest_lazy
 from lhotse.cut import Cut
 from lhotse.supervision import AlignmentItem
 from lhotse.serialization import SequentialJsonlWriter
-from textsearch.utils import AttributeDict, setup_logger
+from textsearch.utils import AttributeDict, setup_logger, str2bool
 
 
 def num_tokens(
@@ -136,6 +137,14 @@ def get_parser():
         """,
     )
 
+    parser.add_argument(
+        "--use-amp",
+        type=str2bool,
+        default=False,
+        help="When enabled, run the decoder and the joiner in bfloat16 "
+        "during decoding on GPU.",
+    )
+
     return parser
 
 
@@ -151,10 +160,90 @@ def get_params() -> AttributeDict:
     return params
 
 
+def get_fbank(config: FbankConfig, device: torch.device):
+    """Return a kaldifeat fbank extractor running on the given device.
+
+    Args:
+      config:
+        The config of the lhotse `Fbank` used by the dataloader when
+        --gpu-fbank is false, see `AsrDataModule.fbank_config()`. The
+        kaldifeat options are copied from it, so that both paths compute
+        the same features.
+      device:
+        The device on which the features are computed.
+    """
+    import kaldifeat
+
+    opts = kaldifeat.FbankOptions()
+    opts.device = device
+    opts.frame_opts.samp_freq = config.sampling_rate
+    opts.frame_opts.dither = config.dither
+    opts.frame_opts.snip_edges = config.snip_edges
+    opts.frame_opts.frame_length_ms = config.frame_length * 1000
+    opts.frame_opts.frame_shift_ms = config.frame_shift * 1000
+    opts.frame_opts.preemph_coeff = config.preemph_coeff
+    opts.frame_opts.remove_dc_offset = config.remove_dc_offset
+    opts.frame_opts.round_to_power_of_two = config.round_to_power_of_two
+    opts.frame_opts.window_type = config.window_type
+    opts.mel_opts.num_bins = config.num_filters
+    opts.mel_opts.low_freq = config.low_freq
+    opts.mel_opts.high_freq = config.high_freq
+    opts.energy_floor = config.energy_floor
+    opts.raw_energy = config.raw_energy
+    opts.use_energy = config.use_energy
+    opts.use_power = not config.use_fft_mag
+    return kaldifeat.Fbank(opts)
+
+
+def compute_features(
+    fbank, batch: dict, sample_rate: int, device: torch.device
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Compute fbank features of a batch containing raw audio samples.
+
+    Args:
+      fbank:
+        The kaldifeat fbank extractor returned by :func:`get_fbank`.
+      batch:
+        A batch from the dataloader with --gpu-fbank enabled, i.e.,
+        batch["inputs"] is of shape (N, S) containing audio samples.
+      sample_rate:
+        The sampling rate `fbank` was created with. All cuts in the batch
+        must have this sampling rate, as required by the lhotse `Fbank`
+        on the CPU path as well.
+      device:
+        The device on which the features are computed.
+    Returns:
+      Return a tuple containing the padded features of shape (N, T, C)
+      and a 1-D tensor with the number of frames of each utterance.
+    """
+    for cut in batch["supervisions"]["cut"]:
+        assert cut.sampling_rate == sample_rate, (
+            cut.id,
+            cut.sampling_rate,
+            sample_rate,
+        )
+
+    audio = batch["inputs"].to(device, non_blocking=True)
+    assert audio.ndim == 2, audio.shape
+    num_samples = batch["supervisions"]["num_samples"].tolist()
+    waves = [audio[i, :n] for i, n in enumerate(num_samples)]
+
+    features = fbank(waves)
+    feature_lens = torch.tensor(
+        [f.size(0) for f in features], dtype=torch.int64, device=device
+    )
+    # Use the same padding value as lhotse
+    feature = torch.nn.utils.rnn.pad_sequence(
+        features, batch_first=True, padding_value=math.log(1e-10)
+    )
+    return feature, feature_lens
+
+
 def decode_one_batch(
     params: AttributeDict,
     model: nn.Module,
     batch: dict,
+    fbank=None,
 ) -> Tuple[List[List[str]], List[List[float]], List[List[float]]]:
     """Decode one batch.
 
@@ -167,19 +256,31 @@ def decode_one_batch(
         It is the return value from iterating
         `lhotse.dataset.K2SpeechRecognitionDataset`. See its documentation
         for the format of the `batch`.
+      fbank:
+        If not None, batch["inputs"] contains raw audio samples and
+        the features are computed with it. See :func:`get_fbank`.
 
     Returns:
       Return the decoding result, timestamps, and scores.
     """
     device = next(model.parameters()).device
-    feature = batch["inputs"]
-    assert feature.ndim == 3
+    # Note: With --cuda-prefetch, batch["inputs"] and
+    # batch["supervisions"]["num_frames"] are already on `device`, and the
+    # `.to(device)` calls below are no-ops. Otherwise, they do the copy.
+    if fbank is not None:
+        feature, feature_lens = compute_features(
+            fbank, batch, params.sample_rate, device
+        )
+    else:
+        feature = batch["inputs"]
+        assert feature.ndim == 3
 
-    feature = feature.to(device)
-    # at entry, feature is (N, T, C)
+        # It is asynchronous if the dataloader returns pinned memory.
+        feature = feature.to(device, non_blocking=True)
 
-    supervisions = batch["supervisions"]
-    feature_lens = supervisions["num_frames"].to(device)
+        supervisions = batch["supervisions"]
+        feature_lens = supervisions["num_frames"].to(device, non_blocking=True)
+    # at entry, feature is (N, T, C)
 
     encoder_out, encoder_out_lens = model.encoder(
         features=feature,
@@ -191,6 +292,7 @@ def decode_one_batch(
             model=model,
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
+            use_amp=params.use_amp,
         )
     elif params.decoding_method == "modified_beam_search":
         res = modified_beam_search(
@@ -198,6 +300,7 @@ def decode_one_batch(
             encoder_out=encoder_out,
             encoder_out_lens=encoder_out_lens,
             beam=params.beam_size,
+            use_amp=params.use_amp,
         )
     else:
         raise ValueError(
@@ -222,17 +325,19 @@ def decode_one_batch(
 
 
 def decode_dataset(
-    dl: torch.utils.data.DataLoader,
+    dl: Iterable[dict],
     params: AttributeDict,
     model: nn.Module,
     token_table: SymbolTable,
     cuts_writer: SequentialJsonlWriter,
+    fbank=None,
 ) -> None:
     """Decode dataset and store the recognition results to manifest.
 
     Args:
       dl:
-        PyTorch's dataloader containing the dataset to decode.
+        PyTorch's dataloader containing the dataset to decode. It may be
+        wrapped by a `CUDAPrefetcher`, see :class:`AsrDataModule`.
       params:
         It is returned by :func:`get_params`.
       model:
@@ -241,6 +346,8 @@ def decode_dataset(
         The table to map tokens to texts.
       cuts_writer:
         Writer to save the cuts with recognition results.
+      fbank:
+        The fbank extractor used when --gpu-fbank is true.
 
     Returns:
       Return a dict, whose key may be "greedy_search" if greedy search
@@ -288,6 +395,7 @@ def decode_dataset(
                 params=params,
                 model=model,
                 batch=batch,
+                fbank=fbank,
             )
 
             futures.append(
@@ -338,6 +446,9 @@ def run(rank, world_size, args, in_cuts):
     device = torch.device("cpu")
     if torch.cuda.is_available():
         device = torch.device("cuda", rank)
+        # Pinned memory (dataloader and beam search buffers) is allocated
+        # on the current device, which would be GPU 0 in every rank.
+        torch.cuda.set_device(device)
     logging.info(f"device: {device}")
 
     logging.info("Loading jit model")
@@ -359,7 +470,15 @@ def run(rank, world_size, args, in_cuts):
             f"{params.cuts_filename}" + params.suffix
         )
 
-    dl = asr_data_module.dataloaders(in_cuts)
+    dl = asr_data_module.dataloaders(in_cuts, device=device)
+
+    fbank = None
+    if params.gpu_fbank:
+        # The features are computed in this process so that the
+        # dataloader workers never touch CUDA.
+        fbank_config = asr_data_module.fbank_config()
+        params.sample_rate = fbank_config.sampling_rate
+        fbank = get_fbank(fbank_config, device)
 
     cuts_writer = CutSet.open_writer(out_cuts_filename, overwrite=True)
     decode_dataset(
@@ -368,6 +487,7 @@ def run(rank, world_size, args, in_cuts):
         model=model,
         token_table=token_table,
         cuts_writer=cuts_writer,
+        fbank=fbank,
     )
     cuts_writer.close()
     logging.info(f"Cuts saved to {out_cuts_filename}")